@@ -0,0 +1,328 @@
+import argparse
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import browser
+from browser import HTMLParser, CSSParser, CHUNK_SIZE, style, cascade_priority, \
+    tree_to_list, walk, DocumentLayout, RuleIndex, paint_tree, URL
+
+MB = 1024 * 1024
+
+# Corpora. Generators are seeded, so the same arguments always give the
+# same document.
+
+# synthetic page of about `size` bytes, mixing markup with long text runs
+def make_page(size):
+    paragraph = "<p>" + "lorem <b>ipsum</b> dolor <i>sit</i> amet " * 40 + "x" * 4000 + "</p>\n"
+    parts = ["<html><body>"]
+    total = 0
+    while total < size:
+        parts.append(paragraph)
+        total += len(paragraph)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing",
+         "elit", "sed", "do", "eiusmod", "tempor", "incididunt", "ut", "labore"]
+
+# article-like page of `paragraphs` paragraphs with some inline markup
+def make_article(paragraphs, seed=0):
+    rng = random.Random(seed)
+    parts = ["<html><head><title>bench</title></head><body>"]
+    for i in range(paragraphs):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 120))]
+        words[rng.randrange(len(words))] = "<b>" + rng.choice(WORDS) + "</b>"
+        words[rng.randrange(len(words))] = "<i>" + rng.choice(WORDS) + "</i>"
+        parts.append("<p>" + " ".join(words) + "</p>")
+        if i % 10 == 0:
+            parts.append("<pre>" + " ".join(rng.choice(WORDS) for _ in range(8)) + "</pre>")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+TAGS = ["div", "p", "span", "a", "b", "i", "ul", "li", "em", "section"]
+
+# nested page with about `elements` elements drawn from TAGS
+def make_tree_page(elements, fanout=4, seed=0):
+    rng = random.Random(seed)
+    parts = ["<html><body>"]
+    count = 0
+
+    def emit(depth):
+        nonlocal count
+        for _ in range(fanout):
+            if count >= elements: return
+            tag = rng.choice(TAGS)
+            count += 1
+            parts.append(f"<{tag}>text ")
+            if depth < 8: emit(depth + 1)
+            parts.append(f"</{tag}>")
+
+    while count < elements:
+        emit(0)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+# stylesheet of `count` tag and descendant rules over TAGS
+def make_stylesheet(count, seed=0):
+    rng = random.Random(seed)
+    rules = []
+    for i in range(count):
+        selector = " ".join(rng.choice(TAGS) for _ in range(rng.randint(1, 3)))
+        rules.append(f"{selector} {{ color: c{i}; }}")
+    return "\n".join(rules)
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+# fastest of `repeat` runs; setup builds fresh arguments for each run
+# outside the timed part
+def best_of(repeat, fn, setup=tuple):
+    return min(timed(fn, *setup()) for _ in range(repeat))
+
+# bytes allocated by fn that are still alive once it returns
+def retained(fn, *args):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def feed_chunks(body):
+    parser = HTMLParser()
+    for i in range(0, len(body), CHUNK_SIZE):
+        parser.feed(body[i:i + CHUNK_SIZE])
+    parser.close()
+
+def default_rules():
+    return RuleIndex(sorted(browser.default_style_sheet(), key=cascade_priority))
+
+def styled_page(body):
+    nodes = HTMLParser(body).parse()
+    style(nodes, default_rules())
+    return nodes
+
+def laid_out(nodes):
+    document = DocumentLayout(nodes)
+    document.layout()
+    return document
+
+# Benchmarks. Each returns {case: (value, unit)}, where lower is better.
+
+# parse time should grow linearly with page size
+def bench_parser(repeat, sizes=(1, 4)):
+    results = {}
+    for mb in sizes:
+        body = make_page(mb * MB)
+        results[f"parse {mb}MB"] = (best_of(repeat, lambda: HTMLParser(body).parse()), "s")
+        results[f"parse {mb}MB chunked"] = (best_of(repeat, feed_chunks, lambda: (body,)), "s")
+    return results
+
+def bench_css(repeat, rule_counts=(1000, 5000)):
+    results = {}
+    for count in rule_counts:
+        sheet = make_stylesheet(count)
+        results[f"css {count} rules"] = (best_of(repeat, lambda: CSSParser(sheet).parse()), "s")
+    return results
+
+def bench_cascade(repeat, elements=(10000, 30000), rule_counts=(1000, 3000)):
+    results = {}
+    for n in elements:
+        body = make_tree_page(n)
+        for count in rule_counts:
+            rules = sorted(CSSParser(make_stylesheet(count)).parse(),
+                           key=cascade_priority)
+            results[f"style {n} elements x {count} rules"] = (
+                best_of(repeat, style, lambda: (HTMLParser(body).parse(), rules)), "s")
+    return results
+
+def bench_layout(repeat, paragraphs=(100, 1000)):
+    results = {}
+    for n in paragraphs:
+        nodes = styled_page(make_article(n))
+        results[f"layout {n} paragraphs"] = (best_of(repeat, laid_out, lambda: (nodes,)), "s")
+    return results
+
+def bench_paint(repeat, paragraphs=(100, 1000)):
+    results = {}
+    for n in paragraphs:
+        nodes = styled_page(make_article(n))
+        # blocks cache what they paint, so every run needs a fresh layout
+        results[f"paint {n} paragraphs"] = (
+            best_of(repeat, paint_tree, lambda: (laid_out(nodes), [])), "s")
+    return results
+
+# scrolls a page top to bottom in a real window; needs a display
+def bench_draw(repeat, paragraphs=1000):
+    try:
+        window = browser.Browser()
+    except Exception as e:
+        print(f"draw: skipped ({type(e).__name__}: {e})")
+        return {}
+    page = browser.Page(None)
+    page.nodes = HTMLParser(make_article(paragraphs)).parse()
+    page.rules = default_rules()
+    for stage in ("style", "layout", "paint"):
+        getattr(page, stage)()
+    window.page = page
+    window.show()
+
+    def scroll_through():
+        window.scroll = 0
+        window.draw()
+        while window.scroll + browser.HEIGHT < page.document.height:
+            window.scroll += browser.SCROLL_STEP
+            window.draw()
+        window.window.update()
+
+    elapsed = best_of(repeat, scroll_through)
+    window.window.destroy()
+    browser.set_font_backend(browser.GlyphTableBackend())
+    frames = page.document.height // browser.SCROLL_STEP + 1
+    return {f"draw {paragraphs} paragraphs per frame": (elapsed / frames, "s")}
+
+class BenchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    pages = {}
+
+    def do_GET(self):
+        body = self.pages.get(self.path, b"")
+        self.send_response(200 if body else 404)
+        self.send_header("Content-Length", str(len(body)))
+        # keeps the cache out of the way so every request reaches the server
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# URL.request against a loopback server, over a pooled keep-alive
+# connection and over a new connection each time
+def bench_network(repeat, sizes=(64 * 1024, 4 * MB), requests=20):
+    BenchHandler.pages = {f"/{size}": make_page(size).encode("utf8") for size in sizes}
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BenchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    results = {}
+    try:
+        for size in sizes:
+            url = URL(f"http://127.0.0.1:{port}/{size}")
+
+            def keep_alive():
+                for _ in range(requests):
+                    url.request()
+
+            def new_connection():
+                browser.CONNECTION_POOL.close_all()
+                url.request()
+
+            results[f"request {size // 1024}KB keep-alive"] = (
+                best_of(repeat, keep_alive) / requests, "s")
+            results[f"request {size // 1024}KB new connection"] = (
+                best_of(repeat, new_connection), "s")
+    finally:
+        browser.CONNECTION_POOL.close_all()
+        server.shutdown()
+        server.server_close()
+    return results
+
+def bench_memory(repeat, elements=100000):
+    body = make_tree_page(elements)
+    nodes, dom_bytes = retained(lambda: HTMLParser(body).parse())
+    count = len(tree_to_list(nodes, []))
+    rules = sorted(CSSParser(make_stylesheet(200)).parse(), key=cascade_priority)
+    _, style_bytes = retained(style, nodes, rules)
+    return {
+        f"memory dom {count} nodes": (dom_bytes / count, "B/node"),
+        f"memory style {count} nodes": (style_bytes / count, "B/node"),
+    }
+
+# deeply nested and very wide pages, which used to hit the recursion limit
+def bench_tree_shapes(repeat, depth=10000, width=100000):
+    pages = {
+        f"deep {depth}": "<div>" * depth + "text" + "</div>" * depth,
+        f"wide {width}": "<div>" + "<p>text</p>" * width + "</div>",
+    }
+    results = {}
+    for name, body in pages.items():
+        nodes = HTMLParser(body).parse()
+        results[f"{name} style"] = (timed(style, nodes, []), "s")
+        results[f"{name} walk"] = (timed(lambda: sum(1 for _ in walk(nodes))), "s")
+        document = DocumentLayout(nodes)
+        results[f"{name} layout"] = (timed(document.layout), "s")
+        results[f"{name} paint"] = (timed(paint_tree, document, []), "s")
+    return results
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "css": bench_css,
+    "cascade": bench_cascade,
+    "layout": bench_layout,
+    "paint": bench_paint,
+    "draw": bench_draw,
+    "network": bench_network,
+    "memory": bench_memory,
+    "shapes": bench_tree_shapes,
+}
+
+# cases that got worse than the baseline by more than `threshold`,
+# as (case, old, new)
+def regressions(results, baseline, threshold):
+    found = []
+    for case, (value, unit) in results.items():
+        if case not in baseline: continue
+        old = baseline[case][0]
+        if old > 0 and value > old * (1 + threshold):
+            found.append((case, old, value))
+    return found
+
+def format_value(value, unit):
+    if unit == "s": return f"{value * 1000:10.3f} ms"
+    return f"{value:10.1f} {unit}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the browser benchmarks")
+    parser.add_argument("names", nargs="*", metavar="NAME",
+        help=f"benchmarks to run, from: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="runs per case, keeping the fastest (default: 3)")
+    parser.add_argument("--output", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+        help="compare against results saved with --output; exits 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=0.10,
+        help="slowdown against the baseline counted as a regression (default: 0.10)")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS: parser.error(f"unknown benchmark: {name}")
+
+    # fixed glyph tables keep layout numbers independent of installed fonts
+    browser.set_font_backend(browser.GlyphTableBackend())
+
+    results = {}
+    for name in args.names or list(BENCHMARKS):
+        for case, (value, unit) in BENCHMARKS[name](args.repeat).items():
+            print(f"{case:<45}{format_value(value, unit)}")
+            results[case] = (value, unit)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        found = regressions(results, baseline, args.threshold)
+        for case, old, new in found:
+            unit = baseline[case][1]
+            print(f"regression: {case} {format_value(old, unit).strip()}"
+                  f" -> {format_value(new, unit).strip()}")
+        if found: sys.exit(1)
@@ -1,14 +1,49 @@
 import socket
+import sys
 import ssl
+import codecs
+import threading
+import queue
+import concurrent.futures
+import time
+import contextlib
+import weakref
+import collections
+import bisect
+import itertools
+import hashlib
+import re
+import json
+import mmap
+import tempfile
+import zlib
 import pathlib
 import os
-import tkinter as tk
-import tkinter.font
+# tkinter is only needed for the window and the Tk font backend
+try:
+    import tkinter as tk
+    import tkinter.font
+except ImportError:
+    tk = None
 
 # Default file to load if no URL is provided
 default_path = r"C:\Users\natha\OneDrive\Desktop\default.txt"
 WIDTH, HEIGHT = 800, 600
 SCROLL_STEP = 100
+# How far below the viewport layout runs ahead, and how much more of the
+# page each idle callback lays out
+LAYOUT_AHEAD = HEIGHT
+IDLE_LAYOUT_STEP = 4 * HEIGHT
+# How often the window checks on a page loading in the background
+LOAD_POLL_MS = 16
+# Resizes are applied at most once per this many milliseconds
+RESIZE_DELAY_MS = 16
+# Frames per second the browser draws at most
+FRAME_RATE = 60
+# Approximate memory the back/forward page cache may hold
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+# Size of each read when streaming a response body
+CHUNK_SIZE = 64 * 1024
 HSTEP, VSTEP = 13, 18
 
 # Fonts cache
@@ -16,25 +51,75 @@ FONTS = {}
 
 # Plain HTML Text Node
 class Text:
+    __slots__ = ("text", "children", "parent", "dirty", "child_dirty", "style",
+                 "words", "widths", "metrics")
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        # text never has children, so all text nodes share one empty tuple
+        self.children = ()
         self.parent = parent
+        self.dirty = False
+        self.child_dirty = False
+        self.words = None
+        self.widths = None
+        self.metrics = None
     
     def __repr__(self):
         return repr(self.text)
 
+    def set_text(self, text):
+        self.text = text
+        self.words = self.widths = self.metrics = None
+        mark_dirty(self)
+
+    # the text's words, each with its width plus a space in the metrics
+    # font; kept across layouts until the text or its font changes
+    def measure(self, metrics):
+        if self.metrics is not metrics:
+            if self.words is None: self.words = self.text.split()
+            space = metrics.space
+            self.widths = [metrics.measure(word) + space for word in self.words]
+            self.metrics = metrics
+        return self.words, self.widths
+
 # HTML Element Node
 class Element:
+    __slots__ = ("tag", "attributes", "children", "parent", "dirty",
+                 "child_dirty", "style")
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.attributes = attributes
         self.children = []
         self.parent = parent
+        self.dirty = False
+        self.child_dirty = False
     
     def __repr__(self):
         return "<" + self.tag + ">"
 
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+        mark_dirty(self)
+
+# flags node for restyle and relayout, and its ancestors as leading to it
+def mark_dirty(node):
+    node.dirty = True
+    node = node.parent
+    while node and not node.child_dirty:
+        node.child_dirty = True
+        node = node.parent
+
+# clears the flags under node, visiting only flagged nodes
+def clear_dirty(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not (node.dirty or node.child_dirty): continue
+        node.dirty = node.child_dirty = False
+        stack.extend(node.children)
+
 INHERITED_PROPERTIES = {
     "font-size": "16px",
     "font-style": "normal",
@@ -42,54 +127,172 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
-# Applies style information to each node in DOM tree
-def style(node, rules):
-        node.style = {}
+# Interned computed styles, so equal styles are one shared object
+COMPUTED_STYLES = weakref.WeakValueDictionary()
 
-        # Inherit font properties from parent or default
-        for property, default_value in INHERITED_PROPERTIES.items():
-            if node.parent:
-                node.style[property] = node.parent.style[property]
-            else:
-                node.style[property] = default_value
+# An immutable set of resolved properties, with the values layout needs
+# already parsed into numbers
+class ComputedStyle:
+    __slots__ = ("properties", "font_size", "font_key", "color", "__weakref__")
 
-        # Apply matching style sheet rules
-        for selector, body in rules:
-            if not selector.matches(node): continue
-            for property, value in body.items():
-                node.style[property] = value
-
-        # Style attribute trumps style sheet rules
-        if isinstance(node, Element) and "style" in node.attributes:
-            pairs = CSSParser(node.attributes["style"]).body()
-            for property, value in pairs.items():
-                node.style[property] = value
-
-        # Resolving font-size percentages
-        if node.style["font-size"].endswith("%"):
-            if node.parent:
-                parent_font_size = node.parent.style["font-size"]
-            else:
-                parent_font_size = INHERITED_PROPERTIES["font-size"]
-            node_pct = float(node.style["font-size"][:-1]) / 100
-            parent_px = float(parent_font_size[:-2])
-            node.style["font-size"] = str(node_pct * parent_px) + "px"
+    def __init__(self, properties, font_size):
+        self.properties = properties
+        self.font_size = font_size
+        style = properties["font-style"]
+        if style == "normal": style = "roman"
+        self.font_key = (int(font_size * .75), properties["font-weight"], style)
+        self.color = properties["color"]
+
+    @staticmethod
+    def intern(properties, font_size):
+        key = tuple(sorted(properties.items()))
+        style = COMPUTED_STYLES.get(key)
+        if style is None:
+            style = ComputedStyle(properties, font_size)
+            COMPUTED_STYLES[key] = style
+        return style
+
+    def __getitem__(self, property):
+        return self.properties[property]
+
+    def __contains__(self, property):
+        return property in self.properties
+
+    def get(self, property, default=None):
+        return self.properties.get(property, default)
+
+    def items(self):
+        return self.properties.items()
+
+# cascades matched rule bodies and the style attribute over the inherited
+# properties of parent_style
+def compute_style(parent_style, bodies, inline):
+    properties = {}
+
+    # Inherit font properties from parent or default
+    for property, default_value in INHERITED_PROPERTIES.items():
+        if parent_style:
+            properties[property] = parent_style[property]
+        else:
+            properties[property] = default_value
+
+    # Apply matching style sheet rules
+    for body in bodies:
+        properties.update(body)
 
-        for child in node.children:
-            style(child, rules)
+    # Style attribute trumps style sheet rules
+    if inline is not None:
+        properties.update(parse_inline_style(inline))
+
+    if parent_style:
+        parent_px = parent_style.font_size
+    else:
+        parent_px = float(INHERITED_PROPERTIES["font-size"][:-2])
+
+    # Resolving font-size percentages
+    font_size = properties["font-size"]
+    try:
+        if font_size.endswith("%"):
+            px = float(font_size[:-1]) / 100 * parent_px
+            properties["font-size"] = str(px) + "px"
+        else:
+            px = float(font_size[:-2])
+    except ValueError:
+        # unsupported units fall back to the inherited size
+        px = parent_px
+        properties["font-size"] = str(px) + "px"
+
+    return ComputedStyle.intern(properties, px)
+
+# Applies style information to each node in DOM tree
+def style(node, rules):
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    style_node(node, rules, {})
+
+# ancestors counts the tags of every open element above node, so
+# descendant selectors can be rejected without walking up the tree; the
+# walk uses an explicit stack, where a tag string marks leaving that element
+def style_node(node, rules, ancestors):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            ancestors[node] -= 1
+            if not ancestors[node]: del ancestors[node]
+            continue
+
+        parent_style = node.parent.style if node.parent else None
+        matched = tuple(rules.matching(node, ancestors))
+        if isinstance(node, Element):
+            inline = node.attributes.get("style")
+        else:
+            inline = None
+
+        # Nodes with the same parent style, rules and style attribute
+        # share one computed style
+        key = (parent_style, matched, inline)
+        node.style = rules.styles.get(key)
+        if node.style is None:
+            node.style = compute_style(
+                parent_style, [rules.bodies[i] for i in matched], inline)
+            rules.styles[key] = node.style
+
+        if not node.children: continue
+        tag = node.tag
+        ancestors[tag] = ancestors.get(tag, 0) + 1
+        stack.append(tag)
+        stack.extend(reversed(node.children))
+
+# restyles only the subtrees under nodes marked dirty since the last pass
+def restyle(node, rules):
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    ancestors = {}
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            ancestors[node] -= 1
+            if not ancestors[node]: del ancestors[node]
+            continue
+
+        if node.dirty:
+            style_node(node, rules, ancestors)
+            continue
+        if not node.child_dirty: continue
+
+        tag = node.tag
+        ancestors[tag] = ancestors.get(tag, 0) + 1
+        stack.append(tag)
+        stack.extend(reversed(node.children))
 
 # Drawing Primitives
 class DrawText:
-    def __init__(self, x1, y1, text, font, color):
+    __slots__ = ("top", "left", "text", "font", "font_key", "color", "bottom")
+
+    def __init__(self, x1, y1, text, metrics, color):
         self.top = y1
         self.left = x1
         self.text = text
-        self.font = font
+        self.font = metrics.font
+        self.font_key = metrics.key
         self.color = color
-        self.bottom = y1 + font.metrics("linespace")
+        self.bottom = y1 + metrics.linespace
+
+    def to_dict(self):
+        return {"type": "text", "left": self.left, "top": self.top,
+                "bottom": self.bottom, "text": self.text,
+                "font": list(self.font_key), "color": self.color}
+
+    def shift(self, dy):
+        self.top += dy
+        self.bottom += dy
 
     def execute(self, scroll, canvas):
-        canvas.create_text(
+        count_call("create_text")
+        return canvas.create_text(
             self.left, self.top - scroll,
             text=self.text,
             font=self.font,
@@ -97,6 +300,8 @@ class DrawText:
             anchor='nw')
 
 class DrawRect:
+    __slots__ = ("top", "left", "bottom", "right", "color")
+
     def __init__(self, x1, y1, x2, y2, color):
         self.top = y1
         self.left = x1
@@ -104,8 +309,17 @@ class DrawRect:
         self.right = x2
         self.color = color
 
+    def to_dict(self):
+        return {"type": "rect", "left": self.left, "top": self.top,
+                "right": self.right, "bottom": self.bottom, "color": self.color}
+
+    def shift(self, dy):
+        self.top += dy
+        self.bottom += dy
+
     def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+        count_call("create_rectangle")
+        return canvas.create_rectangle(
             self.left, self.top - scroll,
             self.right, self.bottom - scroll,
             width=0,
@@ -126,10 +340,16 @@ class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.subject = tag
+        self.ancestor_tags = frozenset()
 
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
+    # node is already known to have the subject tag
+    def matches_indexed(self, node, ancestors):
+        return True
+
 
 # Matches elements with a given ancestor tag (e.g. div p)
 class DescendantSelector:
@@ -137,6 +357,8 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        self.subject = descendant.subject
+        self.ancestor_tags = ancestor.ancestor_tags | {ancestor.subject}
 
     def matches(self, node):
         if not self.descendant.matches(node): return False
@@ -145,119 +367,154 @@ class DescendantSelector:
             node = node.parent
         return False
 
+    # rejects on the ancestor tag counts first; only chains longer than
+    # "a b" need the full walk, since the counts ignore ordering
+    def matches_indexed(self, node, ancestors):
+        for tag in self.ancestor_tags:
+            if tag not in ancestors: return False
+        if isinstance(self.ancestor, TagSelector): return True
+        return self.matches(node)
+
+
+# Rules bucketed by the tag their selector's rightmost part matches, so a
+# node is only tested against rules that could apply to it
+class RuleIndex:
+    def __init__(self, rules):
+        self.buckets = {}
+        self.bodies = []
+        for selector, body in rules:
+            self.buckets.setdefault(selector.subject, []).append(
+                (selector, len(self.bodies)))
+            self.bodies.append(body)
+
+        # computed styles already produced with these rules
+        self.styles = {}
 
-# Recursive Parser for CSS
+    # yields the positions of matching rules, in the order the rules were given
+    def matching(self, node, ancestors):
+        if not isinstance(node, Element): return
+        for selector, position in self.buckets.get(node.tag, ()):
+            if selector.matches_indexed(node, ancestors):
+                yield position
+
+
+# CSS parser driven by compiled regular expressions: a rule or declaration
+# that does not match is skipped up to the next "}" or ";"
 class CSSParser:
+    WORD = r"(?:[^\W_]|[#\-.%])+"
+    WORDS = re.compile(WORD)
+    WHITESPACE = re.compile(r"\s*")
+    # selector words up to the opening brace
+    RULE_START = re.compile(r"\s*(" + WORD + r"(?:\s+" + WORD + r")*)\s*\{\s*")
+    PAIR = re.compile(r"(" + WORD + r")\s*:\s*(" + WORD + r")\s*")
+    SKIP_DECLARATION = re.compile(r"[^;}]*")
+
     def __init__(self, s):
         self.s = s
         self.i = 0
 
     def parse(self):
         rules = []
-        while self.i < len(self.s):
-            try:
-                self.whitespace()
-                selector = self.selector()
-                self.literal("{")
-                self.whitespace()
+        s = self.s
+        while self.i < len(s):
+            m = self.RULE_START.match(s, self.i)
+            if m:
+                self.i = m.end()
                 body = self.body()
-                self.literal("}")
-                rules.append((selector, body))
-            except Exception:
-                why = self.ignore_until(["}"])
-                if why == "}":
-                    self.literal("}")
-                    self.whitespace()
-                else:
-                    break
+                if self.i < len(s):
+                    # body only stops early at the closing brace
+                    self.i += 1
+                    rules.append((self.selector(m.group(1)), body))
+                    continue
+
+            end = s.find("}", self.i)
+            if end < 0: break
+            self.i = self.WHITESPACE.match(s, end + 1).end()
 
         return rules
 
     def body(self):
         pairs = {}
-        while self.i < len(self.s) and self.s[self.i] != "}":
-            try:
-                prop, val = self.pair()
-                pairs[prop.casefold()] = val
-                self.whitespace()
-                self.literal(";")
-                self.whitespace()
-            except Exception:
-                why = self.ignore_until([";", "}"])
-                if why == ";":
-                    self.literal(";")
-                    self.whitespace()
-                else:
-                    break
+        s = self.s
+        while self.i < len(s) and s[self.i] != "}":
+            m = self.PAIR.match(s, self.i)
+            if m:
+                pairs[m.group(1).casefold()] = m.group(2)
+                self.i = m.end()
+            # a declaration that did not parse, or that has anything but ";"
+            # after its value, is skipped
+            if not m or s[self.i:self.i + 1] != ";":
+                self.i = self.SKIP_DECLARATION.match(s, self.i).end()
+                if self.i == len(s) or s[self.i] == "}": break
+            self.i = self.WHITESPACE.match(s, self.i + 1).end()
         return pairs
 
-    def selector(self):
-        out = TagSelector(self.word().casefold())
-        self.whitespace()
-        while self.i < len(self.s) and self.s[self.i] != "{":
-            tag = self.word()
-            descendant = TagSelector(tag.casefold())
-            out = DescendantSelector(out, descendant)
-            self.whitespace()
+    def selector(self, text):
+        tags = self.WORDS.findall(text)
+        out = TagSelector(tags[0].casefold())
+        for tag in tags[1:]:
+            out = DescendantSelector(out, TagSelector(tag.casefold()))
         return out
 
-    def pair(self):
-        prop = self.word()
-        self.whitespace()
-        self.literal(":")
-        self.whitespace()
-        val = self.word()
-        return prop.casefold(), val
-
-    def word(self):
-        start = self.i
-        while self.i < len(self.s):
-            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
-                self.i += 1
-            else:
-                break
-        if not (self.i > start):
-            raise Exception("Parsing error")
-        return self.s[start:self.i]
-
-    def literal(self, literal):
-        if not (self.i < len(self.s) and self.s[self.i] == literal):
-            raise Exception("Parsing error")
-        self.i += 1
-
-    def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
-
-    # currently unsupported pairs
-    def ignore_until(self, chars):
-        while self.i < len(self.s):
-            if self.s[self.i] in chars:
-                return self.s[self.i]
-            else:
-                self.i += 1
-        return None
+
+# Parsed style sheets by a hash of their text, so a sheet shared by several
+# pages or fetched again is only parsed once; the rule lists are shared and
+# must not be changed
+MAX_CACHED_STYLESHEETS = 64
+PARSED_STYLESHEETS = collections.OrderedDict()
+
+def parse_stylesheet(text):
+    key = hashlib.sha256(text.encode("utf8")).digest()
+    rules = PARSED_STYLESHEETS.get(key)
+    if rules is None:
+        rules = CSSParser(text).parse()
+        PARSED_STYLESHEETS[key] = rules
+        if len(PARSED_STYLESHEETS) > MAX_CACHED_STYLESHEETS:
+            PARSED_STYLESHEETS.popitem(last=False)
+    else:
+        PARSED_STYLESHEETS.move_to_end(key)
+    return rules
+
+# Parsed style attributes by their text, which pages tend to repeat on many
+# elements; the bodies are shared and must not be changed
+MAX_CACHED_INLINE_STYLES = 10000
+INLINE_STYLES = collections.OrderedDict()
+
+def parse_inline_style(text):
+    body = INLINE_STYLES.get(text)
+    if body is None:
+        body = CSSParser(text).body()
+        INLINE_STYLES[text] = body
+        if len(INLINE_STYLES) > MAX_CACHED_INLINE_STYLES:
+            INLINE_STYLES.popitem(last=False)
+    else:
+        INLINE_STYLES.move_to_end(text)
+    return body
 
 
 class HTMLParser:
-    def __init__(self, body):
+    SELF_CLOSING_TAGS = frozenset([
+        "area", "base", "br", "col", "embed", "hr", "img", "input",
+        "link", "meta", "param", "source", "track", "wbr",
+        "command", "keygen", "menuitem", "source", "track"
+    ])
+
+    HEAD_TAGS = frozenset([
+        "base", "basefont", "bgsound", "noscript",
+        "link", "meta", "title", "style", "script",
+    ])
+
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
-        self.SELF_CLOSING_TAGS = [
-            "area", "base", "br", "col", "embed", "hr", "img", "input",
-            "link", "meta", "param", "source", "track", "wbr",
-            "command", "keygen", "menuitem", "source", "track"
-        ]
-
-        self.HEAD_TAGS = [
-            "base", "basefont", "bgsound", "noscript",
-            "link", "meta", "title", "style", "script",
-        ]
+        self.pending = []
+        self.in_tag = False
 
     # malformed html handling
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
+            # only the first few open tags matter, so deep trees stay cheap
+            open_tags = [node.tag for node in self.unfinished[:3]]
 
             if open_tags == [] and tag != "html":
                 self.add_tag("html")
@@ -268,13 +525,15 @@ class HTMLParser:
                 else:
                     self.add_tag("body")
             elif open_tags == ["html", "head"] and \
-                 tag not in ["/head"] + self.HEAD_TAGS:
+                 tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else: break
 
-    def get_attributes(self, text):
+    @staticmethod
+    def get_attributes(text):
         parts = text.split()
-        tag = parts[0].casefold()
+        # interned so every node with the same tag shares one string
+        tag = sys.intern(parts[0].casefold())
         attributes = {}
 
         for attrpair in parts[1:]:
@@ -283,10 +542,10 @@ class HTMLParser:
 
                 if len(value) > 2 and value[0] in ["'", "\""]:
                     value = value[1:-1]
-                attributes[key.casefold()] = value
+                attributes[sys.intern(key.casefold())] = value
 
             else:
-                attributes[attrpair.casefold()] = ""
+                attributes[sys.intern(attrpair.casefold())] = ""
 
         return tag, attributes
     
@@ -337,53 +596,50 @@ class HTMLParser:
             node = Element(tag, attributes, parent)
             self.unfinished.append(node)
 
-    def parse(self):
-        text = ""
-        in_tag = False
-
+    # consumes a chunk of markup, emitting every complete tag and text run
+    def feed(self, chunk):
         i = 0
-        while i < len(self.body):
-            c = self.body[i]
-            if c == "<":
-                in_tag = True
-                if text: self.add_text(text)
-                text = ""
-
-            elif c == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
-
-            # elif c == "&":
-            #     if self.body[i+3]:
-            #         if self.body[i+1:i+4] == "lt;":
-            #             in_tag = True
-            #             if text: self.add_text(text)
-            #             text = ""
-            #             i += 3
-
-            #         elif self.body[i+1:i+4] == "gt;":
-            #             in_tag = False
-            #             print(f'tag: {text}')
-            #             self.add_tag(text)
-            #             text = ""
-            #             i += 3
-
-            #         else:
-            #             text += c
-            #     else:
-            #         text += c
-
+        n = len(chunk)
+        while i < n:
+            if self.in_tag:
+                j = chunk.find(">", i)
+                if j == -1:
+                    self.pending.append(chunk[i:])
+                    return
+                self.pending.append(chunk[i:j])
+                self.in_tag = False
+                self.add_tag("".join(self.pending))
             else:
-                text += c
-            i += 1
-
-        if not in_tag and text: self.add_text(text)
+                j = chunk.find("<", i)
+                if j == -1:
+                    self.pending.append(chunk[i:])
+                    return
+                self.pending.append(chunk[i:j])
+                self.in_tag = True
+                text = "".join(self.pending)
+                if text: self.add_text(text)
+            self.pending = []
+            i = j + 1
+
+    # flushes trailing text and returns the root of the finished tree
+    def close(self):
+        text = "".join(self.pending)
+        self.pending = []
+        if not self.in_tag and text: self.add_text(text)
         return self.finish()
 
+    def parse(self):
+        self.feed(self.body)
+        return self.close()
+
 # Layout Classes for rendering HTML
 # DocumentLayout is the root of the layout tree, BlockLayout handles block elements
 class DocumentLayout:
+    __slots__ = (
+        "node", "parent", "children", "x", "y", "width", "height",
+        "pending", "bottom", "total_chars", "laid_out_chars",
+    )
+
     def __init__(self, node):
         self.node = node
         self.parent = None
@@ -392,16 +648,93 @@ class DocumentLayout:
         self.y = None
         self.width = None
         self.height = None
-
-    def layout(self):
+        self.pending = []
+        self.bottom = None
+        self.total_chars = 0
+        self.laid_out_chars = 0
+
+    # lays out the blocks that start above until, or the whole document
+    # when until is None, for a viewport width wide; extend carries on from
+    # where this stopped
+    def layout(self, until=None, width=WIDTH):
         child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        self.children = [child]
 
-        self.width = WIDTH - 2*HSTEP
+        self.width = width - 2*HSTEP
         self.x = HSTEP
         self.y = VSTEP
 
-        child.layout()
+        self.pending = [(child, False)]
+        self.bottom = self.y
+        # only a partial layout needs its height estimated
+        self.total_chars = text_length(self.node) if until is not None else 0
+        self.laid_out_chars = 0
+        self.extend(until)
+
+    # continues the block walk of layout in document order, stopping at the
+    # first block that would start at or below until; returns the blocks
+    # laid out, in paint order
+    def extend(self, until=None):
+        blocks = []
+        stack = self.pending
+        while stack:
+            blk, leaving = stack[-1]
+            if leaving:
+                stack.pop()
+                blk.height = sum(child.height for child in blk.children)
+                continue
+
+            if until is not None:
+                if blk.previous:
+                    y = blk.previous.y + blk.previous.height
+                else:
+                    y = blk.parent.y
+                if y >= until: break
+
+            stack.pop()
+            blocks.append(blk)
+            if blk.layout_self():
+                stack.append((blk, True))
+                stack.extend((child, False) for child in reversed(blk.children))
+            else:
+                self.bottom = blk.y + blk.height
+                if self.total_chars:
+                    self.laid_out_chars += text_length(blk.node)
+
+        self.height = self.estimate_height()
+        return blocks
+
+    @property
+    def complete(self):
+        return not self.pending
+
+    # the real height once layout is complete; until then the height laid
+    # out so far, scaled up by how much of the page's text is still to come
+    def estimate_height(self):
+        if self.complete: return self.children[0].height
+        done = self.bottom - self.y
+        if not self.laid_out_chars: return done
+        return max(done, done * self.total_chars / self.laid_out_chars)
+
+    # lays the document out for a new viewport width, returning False if
+    # the width did not change; a complete layout is updated in place, while
+    # a partial one starts over down to until
+    def resize(self, width, until=None):
+        if width - 2*HSTEP == self.width: return False
+        if not self.complete:
+            self.layout(until, width)
+            return True
+        self.width = width - 2*HSTEP
+        child = self.children[0]
+        child.resize()
+        self.height = child.height
+        return True
+
+    # lays out again only the blocks whose DOM changed since the last layout
+    def relayout(self):
+        self.extend()
+        child = self.children[0]
+        child.relayout()
         self.height = child.height
 
     def paint(self):
@@ -409,6 +742,21 @@ class DocumentLayout:
 
 
 class BlockLayout:
+    __slots__ = (
+        "node", "parent", "previous", "children", "display_list",
+        "x", "y", "cursor_x", "cursor_y", "width", "height", "cmds", "line",
+        "line_width",
+    )
+
+    BLOCK_ELEMENTS = frozenset([
+        "html", "body", "article", "section", "nav", "aside",
+        "h1", "h2", "h3", "h4", "h5", "h6", "hgroup", "header",
+        "footer", "address", "p", "hr", "pre", "blockquote",
+        "ol", "ul", "menu", "li", "dl", "dt", "dd", "figure",
+        "figcaption", "main", "div", "table", "form", "fieldset",
+        "legend", "details", "summary"
+    ])
+
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
@@ -422,17 +770,16 @@ class BlockLayout:
         self.cursor_y = 0
         self.width = None
         self.height = None
+        self.cmds = None
+        self.line = None
+        self.line_width = None
 
-        self.BLOCK_ELEMENTS = [
-            "html", "body", "article", "section", "nav", "aside",
-            "h1", "h2", "h3", "h4", "h5", "h6", "hgroup", "header",
-            "footer", "address", "p", "hr", "pre", "blockquote",
-            "ol", "ul", "menu", "li", "dl", "dt", "dd", "figure",
-            "figcaption", "main", "div", "table", "form", "fieldset",
-            "legend", "details", "summary"
-        ]
-
+    # draw commands are kept until the block is laid out again
     def paint(self):
+        if self.cmds is not None: return self.cmds
+        # not laid out yet, or still waiting for its children
+        if self.height is None: return []
+
         cmds = []
         if self.layout_mode() == "inline":
             bgcolor = self.node.style.get("background-color", "transparent")
@@ -441,14 +788,29 @@ class BlockLayout:
                 rect = DrawRect(self.x, self.y, x2, y2, bgcolor)
                 cmds.append(rect)
 
-            for x, y, word, font, color in self.display_list:
-                cmds.append(DrawText(x, y, word, font, color))
+            for x, y, word, metrics, color in self.display_list:
+                cmds.append(DrawText(x, y, word, metrics, color))
 
+        self.cmds = cmds
         return cmds
     
 
-    # lays out the block, recursively building children and calculating height
+    # lays out the block and everything under it, walking the blocks with an
+    # explicit stack; a block's height is summed once its children are done
     def layout(self):
+        stack = [(self, False)]
+        while stack:
+            blk, leaving = stack.pop()
+            if leaving:
+                # Bottom–up: sum up their heights
+                blk.height = sum(child.height for child in blk.children)
+            elif blk.layout_self():
+                stack.append((blk, True))
+                stack.extend((child, False) for child in reversed(blk.children))
+
+    # lays out this block alone: inline blocks are finished here, block
+    # mode ones build their children and return True so they get laid out
+    def layout_self(self):
         # 1) Top–down: establish this block’s x, y, width
         if self.previous:
             self.y = self.previous.y + self.previous.height
@@ -457,23 +819,20 @@ class BlockLayout:
 
         self.x = self.parent.x
         self.width = self.parent.width
+        self.cmds = None
 
         mode = self.layout_mode()
 
         if mode == "block":
             # Build children
+            self.children = []
             prev = None
             for html_child in self.node.children:
                 blk = BlockLayout(html_child, self, prev)
                 self.children.append(blk)
                 prev = blk
 
-            # Recurse into children
-            for blk in self.children:
-                blk.layout()
-
-            # Bottom–up: sum up their heights
-            self.height = sum(blk.height for blk in self.children)
+            return True
 
         else:  # inline leaf
             # Reset cursors & styles
@@ -483,6 +842,8 @@ class BlockLayout:
             # self.style    = "roman"
             # self.size     = 12
             self.line     = []
+            self.display_list = []
+            self.line_width = 0
 
             # Lay out text into display_list
             self.recurse(self.node)
@@ -490,6 +851,79 @@ class BlockLayout:
 
             # Bottom–up: use the final cursor_y as our height
             self.height = self.cursor_y
+            return False
+
+    # lays out dirty subtrees again and moves clean blocks below them
+    # by however much the blocks above grew or shrank
+    def relayout(self):
+        stack = [(self, False)]
+        while stack:
+            blk, leaving = stack.pop()
+            node = blk.node
+            if leaving:
+                blk.height = sum(child.height for child in blk.children)
+                node.child_dirty = False
+                continue
+
+            if node.dirty or (node.child_dirty and blk.layout_mode() == "inline"):
+                blk.layout()
+                clear_dirty(node)
+                continue
+
+            if blk.previous:
+                y = blk.previous.y + blk.previous.height
+            else:
+                y = blk.parent.y
+            if y != blk.y: blk.shift(y - blk.y)
+
+            if node.child_dirty:
+                stack.append((blk, True))
+                stack.extend((child, False) for child in reversed(blk.children))
+
+    # lays the tree out again at its parent's new width; inline blocks that
+    # were a single line and still fit keep their lines and just move
+    def resize(self):
+        stack = [(self, False)]
+        while stack:
+            blk, leaving = stack.pop()
+            if leaving:
+                blk.height = sum(child.height for child in blk.children)
+                continue
+
+            node = blk.node
+            if node.dirty or node.child_dirty:
+                blk.layout()
+                continue
+
+            if blk.previous:
+                y = blk.previous.y + blk.previous.height
+            else:
+                y = blk.parent.y
+            blk.width = blk.parent.width
+            blk.cmds = None
+
+            if blk.layout_mode() == "inline":
+                if blk.line_width is not None and blk.line_width <= blk.width:
+                    blk.shift(y - blk.y)
+                else:
+                    blk.layout()
+                continue
+
+            blk.y = y
+            stack.append((blk, True))
+            stack.extend((child, False) for child in reversed(blk.children))
+
+    def shift(self, dy):
+        stack = [self]
+        while stack:
+            blk = stack.pop()
+            blk.y += dy
+            blk.display_list = [
+                (x, y + dy, word, metrics, color)
+                for x, y, word, metrics, color in blk.display_list]
+            if blk.cmds:
+                for cmd in blk.cmds: cmd.shift(dy)
+            stack.extend(blk.children)
 
     # determines the layout method for the block, e.g - inline or block
     def layout_mode(self):
@@ -508,119 +942,849 @@ class BlockLayout:
     def flush(self):
         if not self.line: return
 
-        metrics = [font.metrics() for x, word, font, color in self.line]
-        max_ascent = max([metric["ascent"] for metric in metrics])
+        max_ascent = max([metrics.ascent for x, word, metrics, color in self.line])
         baseline = self.cursor_y + 1.25 * max_ascent
 
-        for rel_x, word, font, color in self.line:
+        for rel_x, word, metrics, color in self.line:
             x = self.x + rel_x
-            y = self.y + baseline - font.metrics("ascent")
-            self.display_list.append((x, y, word, font, color))
+            y = self.y + baseline - metrics.ascent
+            self.display_list.append((x, y, word, metrics, color))
 
-        max_descent = max([metric["descent"] for metric in metrics])
+        max_descent = max([metrics.descent for x, word, metrics, color in self.line])
+        # the width of the first line, while it is the only one
+        self.line_width = self.cursor_x if self.cursor_y == 0 else None
         self.cursor_y = baseline + 1.25 * max_descent
 
         self.cursor_x = 0
         self.line = []
 
-    def word(self, node, word):
-        color = node.style["color"]
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int(float(node.style["font-size"][:-2]) * .75)
-        font = get_font(size, weight, style)
-
-        w = font.measure(word)
-        if self.cursor_x + w > self.width:
-            self.flush()
-
-        self.line.append((self.cursor_x, word, font, color))
-        self.cursor_x += w + font.measure(" ")
+    # breaks a run of text nodes sharing one style into line segments, one
+    # per line: the run is measured once as running totals of word widths,
+    # and each line break is found by bisecting those totals
+    def text_run(self, style, texts):
+        if not texts: return
+        color = style.color
+        metrics = get_metrics(*style.font_key)
+        space = metrics.space
+
+        words, widths = texts[0].measure(metrics)
+        if len(texts) > 1:
+            words, widths = list(words), list(widths)
+            for text in texts[1:]:
+                more_words, more_widths = text.measure(metrics)
+                words.extend(more_words)
+                widths.extend(more_widths)
+        if not words: return
+
+        # ends[k] is the width of words[:k + 1], each followed by a space
+        ends = list(itertools.accumulate(widths))
 
-    # traverses the tree recursively, handling text and tags
+        i = 0
+        while i < len(words):
+            start = ends[i - 1] if i else 0
+            limit = start + self.width - self.cursor_x + space
+            count = bisect.bisect_right(ends, limit, i) - i
+
+            if count == 0:
+                if self.line:
+                    self.flush()
+                    continue
+                # a word wider than an empty line goes on it anyway
+                count = 1
+
+            text = " ".join(words[i:i + count])
+            self.line.append((self.cursor_x, text, metrics, color))
+            self.cursor_x += ends[i + count - 1] - start
+            i += count
+
+    # traverses the tree in document order, grouping consecutive text nodes
+    # of the same style into runs and handling tags
     def recurse(self, node):
-        if isinstance(node, Text):
-            for word in node.text.split():
-                self.word(node, word)
-        else:
-            if node.tag == "br":
-                self.flush()
-            for child in node.children:
-                self.recurse(child)
+        run_style, texts = None, []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Text):
+                if node.style is not run_style:
+                    self.text_run(run_style, texts)
+                    run_style, texts = node.style, []
+                texts.append(node)
+            else:
+                if node.tag == "br":
+                    self.text_run(run_style, texts)
+                    texts = []
+                    self.flush()
+                stack.extend(reversed(node.children))
+        self.text_run(run_style, texts)
+
+
+# Subresource fetch limits
+MAX_FETCHES_PER_HOST = 6
+FETCH_TIMEOUT = 10
+
+# Timing of a single subresource fetch, in seconds since the batch started
+class ResourceTiming:
+    def __init__(self, href, queued, start, end, ok):
+        self.href = href
+        self.queued = queued
+        self.start = start
+        self.end = end
+        self.ok = ok
 
+    def __repr__(self):
+        status = "ok" if self.ok else "failed"
+        return (f"{self.href}: waited {(self.start - self.queued) * 1000:.1f}ms "
+                f"fetched {self.start * 1000:.1f}-{self.end * 1000:.1f}ms ({status})")
+
+# Fetches hrefs relative to base on a thread pool as they are requested,
+# allowing at most per_host requests in flight to any one origin; each href
+# is fetched once however often it is requested
+class Fetcher:
+    def __init__(self, base, per_host=MAX_FETCHES_PER_HOST, timeout=FETCH_TIMEOUT):
+        self.base = base
+        self.per_host = per_host
+        self.timeout = timeout
+        self.batch_start = time.perf_counter()
+        self.limits = {}
+        self.futures = {}
+        self.pool = concurrent.futures.ThreadPoolExecutor(MAX_CONNECTIONS)
+
+    # starts fetching href unless it already has been; the future's result
+    # is a (timing, body) pair, with body None if the fetch failed
+    def fetch(self, href):
+        if href not in self.futures:
+            queued = time.perf_counter() - self.batch_start
+            try:
+                url = self.base.resolve(href)
+            except Exception:
+                url = None
+            self.futures[href] = self.pool.submit(self.run, href, url, queued)
+        return self.futures[href]
+
+    def run(self, href, url, queued):
+        if url is None:
+            return ResourceTiming(href, queued, queued, queued, False), None
+
+        key = (url.scheme, url.host, getattr(url, "port", None))
+        limit = self.limits.setdefault(key, threading.Semaphore(self.per_host))
+        with limit:
+            start = time.perf_counter() - self.batch_start
+            try:
+                body = url.request(self.timeout)
+            except Exception:
+                body = None
+            end = time.perf_counter() - self.batch_start
+        return ResourceTiming(href, queued, start, end, body is not None), body
+
+    # a caller that stops early does not wait for fetches still running
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+# fetches hrefs concurrently through a Fetcher and yields (timing, body)
+# pairs in the order the hrefs were given
+def fetch_all(base, hrefs, per_host=MAX_FETCHES_PER_HOST, timeout=FETCH_TIMEOUT,
+              fetcher=None):
+    if fetcher is None: fetcher = Fetcher(base, per_host, timeout)
+    try:
+        futures = [fetcher.fetch(href) for href in hrefs]
+        for future in futures:
+            yield future.result()
+    finally:
+        fetcher.close()
+
+# Finds stylesheet links in markup as it streams in, ahead of the parser, so
+# their fetches can start while the rest of the document is downloading.
+# Tags are split out the same way HTMLParser.feed splits them, so it sees
+# the same links the parser will.
+class PreloadScanner:
+    def __init__(self):
+        self.in_tag = False
+        self.pending = []
+
+    # returns the hrefs of stylesheet links completed by chunk
+    def feed(self, chunk):
+        found = []
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self.in_tag:
+                j = chunk.find(">", i)
+                if j == -1:
+                    self.pending.append(chunk[i:])
+                    break
+                self.pending.append(chunk[i:j])
+                self.in_tag = False
+                href = self.stylesheet("".join(self.pending))
+                if href is not None: found.append(href)
+                self.pending = []
+            else:
+                j = chunk.find("<", i)
+                if j == -1: break
+                self.in_tag = True
+            i = j + 1
+        return found
+
+    # the href of a <link rel=stylesheet> tag, or None for any other tag;
+    # only tags that could be links are split into attributes
+    def stylesheet(self, text):
+        if text.lstrip()[:4].casefold() != "link": return None
+        tag, attributes = HTMLParser.get_attributes(text)
+        if tag == "link" and attributes.get("rel") == "stylesheet":
+            return attributes.get("href")
+        return None
 
 # paints the layout tree to the display list
 def paint_tree(layout_object, display_list):
-    display_list.extend(layout_object.paint())
+    stack = [layout_object]
+    while stack:
+        layout_object = stack.pop()
+        display_list.extend(layout_object.paint())
+        stack.extend(reversed(layout_object.children))
+
+
+# Display list commands sorted by top, so the ones overlapping the viewport
+# can be found by bisection. Commands taller than tall are kept aside and
+# checked directly, which bounds how far above the viewport a visible
+# command can start.
+class DisplayIndex:
+    def __init__(self, display_list, tall=HEIGHT):
+        self.tall_height = tall
+        self.tall = []
+        self.reach = 0
+        self.count = 0
+        self.tops = []
+        self.entries = []
+        self.extend(display_list)
+
+    # indexes commands painted after the ones already here; with lazy layout
+    # they start below everything indexed so far and just go on the end
+    def extend(self, display_list):
+        short = []
+        for order, cmd in enumerate(display_list, self.count):
+            height = cmd.bottom - cmd.top
+            if height > self.tall_height:
+                self.tall.append((order, cmd))
+            else:
+                short.append((cmd.top, order, cmd))
+                self.reach = max(self.reach, height)
+            self.count = order + 1
+        short.sort(key=lambda entry: entry[0])
+
+        if short and self.tops and short[0][0] < self.tops[-1]:
+            indexed = [(top, order, cmd)
+                       for top, (order, cmd) in zip(self.tops, self.entries)]
+            short = sorted(indexed + short, key=lambda entry: entry[0])
+            self.tops, self.entries = [], []
+        self.tops.extend(top for top, order, cmd in short)
+        self.entries.extend((order, cmd) for top, order, cmd in short)
+
+    # commands overlapping [top, bottom], in their original paint order
+    def visible(self, top, bottom):
+        start = bisect.bisect_left(self.tops, top - self.reach)
+        end = bisect.bisect_right(self.tops, bottom)
+        found = [entry for entry in self.entries[start:end]
+                 if entry[1].bottom >= top]
+        found.extend(entry for entry in self.tall
+                     if entry[1].top <= bottom and entry[1].bottom >= top)
+        found.sort(key=lambda entry: entry[0])
+        return [cmd for order, cmd in found]
+
+
+# Records how long each pipeline stage takes and how many font and canvas
+# calls it makes, as Chrome trace events (load the JSON in about:tracing or
+# Perfetto)
+class Tracer:
+    def __init__(self):
+        self.events = []
+        self.calls = collections.Counter()
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        args = {}
+        calls = self.calls.copy()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            args["cpu_ms"] = round((time.process_time() - cpu_start) * 1000, 3)
+            for call, n in (self.calls - calls).items():
+                args[call + "_calls"] = n
+            self.events.append({
+                "name": name, "cat": "pipeline", "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(), "tid": threading.get_ident(),
+                "args": args,
+            })
+
+    def to_json(self):
+        return {"traceEvents": self.events, "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f)
+
+# The active tracer, or None when tracing is off
+TRACER = None
+
+def enable_tracing():
+    global TRACER
+    TRACER = Tracer()
+    return TRACER
+
+# times the enclosed block as a trace event; does nothing unless tracing,
+# and yields a dict for extra event args
+@contextlib.contextmanager
+def trace(name):
+    if TRACER is None:
+        yield {}
+    else:
+        with TRACER.stage(name) as args:
+            yield args
 
-    for child in layout_object.children:
-        paint_tree(child, display_list)
+def count_call(name):
+    if TRACER: TRACER.calls[name] += 1
+
+
+# Raised inside a page load stopped by Page.cancel
+class LoadCancelled(Exception):
+    pass
+
+# One document run through the rendering pipeline: fetch, parse, style,
+# layout and paint. Nothing here touches a window, so pages can be rendered
+# headless as long as a font backend that does not need Tk is selected.
+class Page:
+    def __init__(self, url):
+        self.url = url
+        self.nodes = None
+        self.rules = None
+        self.document = None
+        self.display_list = []
+        self.resource_timings = []
+        self.until = None
+        self.width = WIDTH
+        self.cancelled = threading.Event()
+        self.fetcher = None
+
+    # pipeline stages, in the order load runs them
+    STAGES = ("parse", "stylesheets", "style", "layout", "paint")
+    # the stages that never touch Tk, so they can run on a worker thread
+    BACKGROUND_STAGES = ("parse", "stylesheets", "style")
+
+    # with until, layout and paint stop at the first block starting below
+    # it and extend does the rest of the page later; progress is called
+    # with the name of each stage as it finishes
+    def load(self, until=None, stages=STAGES, progress=None):
+        self.until = until
+        for stage in stages:
+            self.check_cancelled()
+            with trace(stage) as args:
+                getattr(self, stage)()
+            # counted outside the timed block; the event shares args
+            if TRACER: args.update(self.counts(stage))
+            if progress: progress(stage)
+        return self
+
+    # stops a load between stages, or between chunks of the body or
+    # stylesheets, once cancel has been called from another thread
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set(): raise LoadCancelled(str(self.url))
+
+    # sizes worth recording alongside a stage's timings
+    def counts(self, stage):
+        if stage == "parse":
+            return {"nodes": sum(1 for _ in walk(self.nodes))}
+        if stage == "stylesheets":
+            return {"rules": len(self.rules.bodies)}
+        if stage == "paint":
+            return {"draw_commands": len(self.display_list)}
+        return {}
+
+    def parse(self):
+        # builds the DOM while the body is still downloading, and starts
+        # fetching stylesheets as soon as the scanner sees their links
+        parser = HTMLParser()
+        scanner = PreloadScanner()
+        self.fetcher = Fetcher(self.url)
+        try:
+            # closing the stream early drops the connection instead of reusing it
+            with contextlib.closing(self.url.stream()) as chunks:
+                for chunk in chunks:
+                    self.check_cancelled()
+                    for href in scanner.feed(chunk):
+                        self.fetcher.fetch(href)
+                    parser.feed(chunk)
+        except BaseException:
+            self.fetcher.close()
+            raise
+        self.nodes = parser.close()
+
+    def stylesheets(self):
+        links = [node.attributes["href"]
+             for node in walk(self.nodes)
+             if isinstance(node, Element)
+             and node.tag == "link"
+             and node.attributes.get("rel") == "stylesheet"
+             and "href" in node.attributes]
+        
+        rules = default_style_sheet().copy()
+
+        # stylesheets download in parallel but are applied in document order;
+        # most were already requested while parsing
+        self.resource_timings = []
+        fetcher = self.fetcher or Fetcher(self.url)
+        self.fetcher = None
+        with contextlib.closing(fetch_all(self.url, links, fetcher=fetcher)) as fetches:
+            for timing, body in fetches:
+                self.check_cancelled()
+                self.resource_timings.append(timing)
+                if body is None: continue
+                rules.extend(parse_stylesheet(body))
+
+        self.rules = RuleIndex(sorted(rules, key=cascade_priority))
+
+    def style(self):
+        style(self.nodes, self.rules)
+
+    def layout(self):
+        self.document = DocumentLayout(self.nodes)
+        self.document.layout(self.until, self.width)
+
+    def paint(self):
+        self.display_list = []
+        paint_tree(self.document, self.display_list)
+
+    # lays out and paints the blocks starting above until (the rest of the
+    # page when None), adding them to the display list; returns the new
+    # draw commands
+    def extend(self, until=None):
+        cmds = []
+        for blk in self.document.extend(until):
+            cmds.extend(blk.paint())
+        self.display_list.extend(cmds)
+        return cmds
+
+    # lays the page out again for a new viewport width and repaints it;
+    # returns False if the width did not change
+    def resize(self, width, until=None):
+        self.width = width
+        if not self.document.resize(width, until): return False
+        self.paint()
+        return True
+
+    # redoes only the work invalidated by DOM changes since the last pass
+    def update(self):
+        restyle(self.nodes, self.rules)
+        self.document.relayout()
+        self.paint()
+
+# Default style sheet, parsed on first use
+DEFAULT_STYLE_SHEET = None
+
+def default_style_sheet():
+    global DEFAULT_STYLE_SHEET
+    if DEFAULT_STYLE_SHEET is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "browser.css")
+        with open(path) as f:
+            DEFAULT_STYLE_SHEET = parse_stylesheet(f.read())
+    return DEFAULT_STYLE_SHEET
+
+# Default number of worker processes for batch rendering
+BATCH_WORKERS = os.cpu_count() or 1
+
+# turns a command line target into a URL; anything without a scheme is a
+# local file, which file: URLs resolve against the home directory
+def target_url(target):
+    if "://" in target:
+        return URL(target)
+    path = os.path.relpath(os.path.abspath(target), pathlib.Path.home())
+    return URL("file:///" + path.replace(os.sep, "/"))
+
+# renders one target headless in a batch worker and returns a JSON-ready
+# summary with the wall time of every pipeline stage in milliseconds
+def render_summary(target, include_display_list=False):
+    record = {"target": target, "ok": False, "timings": {}}
+    try:
+        page = Page(target_url(target))
+        for stage in Page.STAGES:
+            start = time.perf_counter()
+            getattr(page, stage)()
+            record["timings"][stage] = round((time.perf_counter() - start) * 1000, 3)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    record["ok"] = True
+    record["nodes"] = sum(1 for _ in walk(page.nodes))
+    record["rules"] = len(page.rules.bodies)
+    record["stylesheets"] = [repr(timing) for timing in page.resource_timings]
+    record["height"] = page.document.height
+    record["draw_commands"] = len(page.display_list)
+    if include_display_list:
+        record["display_list"] = [cmd.to_dict() for cmd in page.display_list]
+    return record
+
+# renders every target across a pool of worker processes, writing one JSON
+# line per target in input order
+def render_batch(targets, output, workers=BATCH_WORKERS, include_display_list=False):
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        records = pool.map(render_summary, targets,
+                           itertools.repeat(include_display_list))
+        for record in records:
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+
+# runs the pipeline for url without a window, measuring text with backend
+# (the glyph table by default) and returns the finished Page
+def render_headless(url, backend=None):
+    if backend is not None:
+        set_font_backend(backend)
+    elif isinstance(FONT_BACKEND, TkFontBackend):
+        set_font_backend(GlyphTableBackend())
+    return Page(url).load()
+
+
+# Recently left pages, kept whole (DOM, layout tree, display list and scroll
+# offset) so going back to one needs no fetch, parse, style or layout. The
+# least recently left pages are evicted once their approximate sizes add up
+# to more than the budget.
+class PageCache:
+    def __init__(self, budget=PAGE_CACHE_BYTES):
+        self.budget = budget
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def store(self, key, page, scroll):
+        self.take(key)
+        size = approximate_size(page)
+        if size > self.budget: return
+        self.entries[key] = (page, scroll, size)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    # removes and returns the (page, scroll) stored under key, if any
+    def take(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None: return None
+        page, scroll, size = entry
+        self.size -= size
+        return page, scroll
+
+# rough bytes held by a page's DOM, layout tree and display list, with the
+# strings, lists and dicts they own; objects shared between pages, like
+# computed styles and font metrics, are left out
+def approximate_size(page):
+    getsizeof = sys.getsizeof
+    string, number = getsizeof(""), getsizeof(0.0)
+    size = 0
+    for node in walk(page.nodes):
+        size += getsizeof(node)
+        if isinstance(node, Text):
+            size += getsizeof(node.text)
+            if node.words is not None:
+                # the words hold about the text's characters between them
+                size += getsizeof(node.words) + string * len(node.words) + len(node.text)
+                size += getsizeof(node.widths) + number * len(node.widths)
+        else:
+            size += getsizeof(node.children) + getsizeof(node.attributes)
+    if page.document:
+        for blk in walk(page.document):
+            size += getsizeof(blk) + getsizeof(blk.children)
+            if isinstance(blk, BlockLayout):
+                size += getsizeof(blk.display_list) + sum(map(getsizeof, blk.display_list))
+    size += getsizeof(page.display_list)
+    for cmd in page.display_list:
+        size += getsizeof(cmd)
+        if isinstance(cmd, DrawText): size += getsizeof(cmd.text)
+    return size
+
+# Frame counts and times for the frame scheduler. A frame that is presented
+# more than one interval after it was due counts each interval it missed as
+# a dropped frame.
+class FrameStats:
+    def __init__(self, interval):
+        self.interval = interval
+        self.frames = 0
+        self.dropped = 0
+        self.total = 0
+        self.worst = 0
+
+    # returns how many frames this one dropped
+    def record(self, due, start, end):
+        self.frames += 1
+        self.total += end - start
+        self.worst = max(self.worst, end - start)
+        dropped = int((end - due) / self.interval)
+        self.dropped += dropped
+        return dropped
+
+    def __repr__(self):
+        mean = self.total / self.frames * 1000 if self.frames else 0
+        return (f"{self.frames} frames: mean {mean:.1f}ms, "
+                f"worst {self.worst * 1000:.1f}ms, {self.dropped} dropped")
 
 
 class Browser:
-    def __init__(self):
+    TITLE = "Nathan's Beautiful Browser"
+
+    def __init__(self, frame_rate=FRAME_RATE):
+        set_font_backend(TkFontBackend())
         self.window = tk.Tk()
         self.canvas = tk.Canvas(
             self.window, 
             width=WIDTH,
             height=HEIGHT,
             bg="white",
+            # so Configure reports the drawable size
+            highlightthickness=0,
         )
 
-        self.canvas.pack()
-        self.window.title("Nathan's Beautiful Browser")
+        self.canvas.pack(fill="both", expand=True)
+        self.window.title(self.TITLE)
+        self.width, self.height = WIDTH, HEIGHT
+        self.resize_job = None
+        self.page = None
+        self.history = []
+        self.history_index = -1
+        self.page_cache = PageCache()
+        self.loading = None
+        self.poll_job = None
         self.scroll = 0
+        self.items = {}
+        self.drawn_scroll = 0
+        self.layout_job = None
+        # input between frames only adds to these; frame() applies them
+        self.frame_interval = 1 / frame_rate
+        self.frame_job = None
+        self.frame_due = 0
+        self.next_frame = 0
+        self.pending_scroll = 0
+        self.frames = FrameStats(self.frame_interval)
         self.window.bind("<Down>", self.scrolldown)
         self.window.bind("<MouseWheel>", self.on_mousewheel)
-        
+        self.window.bind("<Alt-Left>", self.back)
+        self.window.bind("<Alt-Right>", self.forward)
+        self.canvas.bind("<Configure>", self.on_configure)
+
+    # keeps a canvas item for every visible command: scrolling moves the
+    # existing items and only creates or deletes those crossing the edges
     def draw(self):
+        self.extend_layout(self.scroll + self.height + LAYOUT_AHEAD)
+        with trace("draw"):
+            self.draw_visible()
+
+    def draw_visible(self):
+        if self.drawn_scroll != self.scroll:
+            self.canvas.move("all", 0, self.drawn_scroll - self.scroll)
+            self.drawn_scroll = self.scroll
+
+        visible = self.display_index.visible(self.scroll, self.scroll + self.height)
+        on_screen = set(visible)
+        for cmd in [cmd for cmd in self.items if cmd not in on_screen]:
+            self.canvas.delete(self.items.pop(cmd))
+        for cmd in visible:
+            if cmd not in self.items:
+                self.items[cmd] = cmd.execute(self.scroll, self.canvas)
+
+    # forgets every canvas item, for when the display list is replaced
+    def clear(self):
         self.canvas.delete("all")
-        for cmd in self.display_list:
-            if cmd.top > self.scroll + HEIGHT: continue
-            if cmd.bottom < self.scroll: continue
-            cmd.execute(self.scroll, self.canvas)
+        self.items = {}
+        self.drawn_scroll = self.scroll
 
+    # navigates to url, dropping any forward history; a new navigation
+    # always loads the page afresh
     def load(self, url):
-        body = url.request()
-        self.nodes = HTMLParser(body).parse()
-        
-        links = [node.attributes["href"]
-             for node in tree_to_list(self.nodes, [])
-             if isinstance(node, Element)
-             and node.tag == "link"
-             and node.attributes.get("rel") == "stylesheet"
-             and "href" in node.attributes]
-        
-        rules = DEFAULT_STYLE_SHEET.copy()
-        style(self.nodes, sorted(rules, key=cascade_priority))
-
-        for link in links:
-            style_url = url.resolve(link)
-            try:
-                body = style_url.request()
-            except:
-                continue
-            rules.extend(CSSParser(body).parse())
+        del self.history[self.history_index + 1:]
+        self.history.append(url)
+        self.history_index += 1
+        self.page_cache.take(str(url))
+        self.cancel_load()
+        self.start_load(url)
+
+    def back(self, e=None):
+        if self.history_index > 0:
+            self.history_index -= 1
+            self.revisit(self.history[self.history_index])
+
+    def forward(self, e=None):
+        if self.history_index + 1 < len(self.history):
+            self.history_index += 1
+            self.revisit(self.history[self.history_index])
+
+    # shows a page from history straight from the page cache, scrolled to
+    # where it was left, or loads it again if it has been evicted
+    def revisit(self, url):
+        self.cancel_load()
+        cached = self.page_cache.take(str(url))
+        if cached:
+            page, scroll = cached
+            self.show_page(page, scroll)
+        else:
+            self.start_load(url)
 
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
+    # fetches, parses and styles the page on a worker thread, so the window
+    # keeps handling events, and polls for it to finish; the current page
+    # stays up and scrollable meanwhile, and a newer load cancels this one
+    def start_load(self, url):
+        page = Page(url)
+        events = queue.Queue()
 
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+        def work():
+            try:
+                page.load(stages=Page.BACKGROUND_STAGES,
+                          progress=lambda stage: events.put((stage, None)))
+            except LoadCancelled:
+                pass
+            except Exception as e:
+                events.put(("error", e))
+
+        self.loading = page
+        self.window.title(f"Loading {url} - {self.TITLE}")
+        threading.Thread(target=work, daemon=True).start()
+        self.poll_job = self.window.after(LOAD_POLL_MS, self.poll_load, page, events)
+
+    def poll_load(self, page, events):
+        self.poll_job = None
+        while not events.empty():
+            stage, error = events.get()
+            if error:
+                self.loading = None
+                self.window.title(f"Failed to load {page.url} - {self.TITLE}")
+                raise error
+            if stage == Page.BACKGROUND_STAGES[-1]:
+                self.loading = None
+                self.present(page)
+                return
+            self.window.title(f"Loading {page.url} ({stage} done) - {self.TITLE}")
+        self.poll_job = self.window.after(LOAD_POLL_MS, self.poll_load, page, events)
+
+    def cancel_load(self):
+        if self.poll_job: self.window.after_cancel(self.poll_job)
+        if self.loading: self.loading.cancel()
+        self.poll_job = self.loading = None
+
+    # lays out just enough of a styled page to fill the first screen and
+    # shows it
+    def present(self, page):
+        page.width = self.width
+        page.load(until=self.height + LAYOUT_AHEAD, stages=("layout", "paint"))
+        self.show_page(page, 0)
+
+    # puts page on screen at scroll, keeping the page it replaces in the
+    # page cache, and lays out whatever is left a stretch at a time while idle
+    def show_page(self, page, scroll):
+        if self.layout_job: self.window.after_cancel(self.layout_job)
+        self.layout_job = None
+        if self.page is not None and self.page is not page:
+            self.page_cache.store(str(self.page.url), self.page, self.scroll)
+        self.page = page
+        # the window may have been resized since the page was left
+        page.resize(self.width, scroll + self.height + LAYOUT_AHEAD)
+        self.scroll = min(scroll, self.max_scroll())
+        self.pending_scroll = 0
+        self.window.title(f"{page.url} - {self.TITLE}")
+        self.show()
+        if not page.document.complete:
+            self.layout_job = self.window.after_idle(self.layout_more)
+
+    def layout_more(self):
+        self.layout_job = None
+        document = self.page.document
+        if document.complete: return
+        self.extend_layout(document.bottom + IDLE_LAYOUT_STEP)
+        if document.complete:
+            # scrolling used the estimated height until now, and the frame
+            # clamps it to the real one
+            self.schedule_frame()
+        else:
+            self.layout_job = self.window.after_idle(self.layout_more)
+
+    # lays out the page down to until if it has not got that far yet
+    def extend_layout(self, until):
+        document = self.page.document
+        if document.complete or document.bottom >= until: return
+        with trace("layout"):
+            cmds = self.page.extend(until)
+        self.display_index.extend(cmds)
+
+    # uses the estimated height of the page while it is still being laid out
+    def max_scroll(self):
+        return max(self.page.document.height + 2*VSTEP - self.height, 0)
+
+    # dragging the window edge sends a stream of these; only the latest
+    # size is applied, once the delay has passed
+    def on_configure(self, event):
+        if (event.width, event.height) == (self.width, self.height): return
+        self.width, self.height = event.width, event.height
+        if self.resize_job is None:
+            self.resize_job = self.window.after(RESIZE_DELAY_MS, self.resize)
+
+    # reflows the page for the new width; a change in height alone only
+    # needs the newly uncovered part drawn
+    def resize(self):
+        self.resize_job = None
+        if not self.page: return
+        until = self.scroll + self.height + LAYOUT_AHEAD
+        with trace("resize"):
+            reflowed = self.page.resize(self.width, until)
+        if reflowed:
+            self.scroll = min(self.scroll, self.max_scroll())
+            self.show()
+        else:
+            self.draw()
+
+    # brings the page up to date after DOM changes, redoing only the
+    # style, layout and paint work the changes invalidated
+    def render(self):
+        self.page.update()
+        self.show()
+
+    # replaces whatever is on the canvas with the page's display list
+    def show(self):
+        self.display_index = DisplayIndex(self.page.display_list)
+        self.clear()
         self.draw()
 
+    # asks for a frame, adding scroll_delta to any scrolling not drawn yet;
+    # a frame is never due sooner than one interval after the last one
+    def schedule_frame(self, scroll_delta=0):
+        self.pending_scroll += scroll_delta
+        if self.frame_job is not None: return
+        now = time.perf_counter()
+        self.frame_due = max(now, self.next_frame)
+        delay = int((self.frame_due - now) * 1000)
+        self.frame_job = self.window.after(delay, self.frame)
+
+    # applies the scrolling since the last frame, clamped to the page, and
+    # draws once
+    def frame(self):
+        self.frame_job = None
+        if not self.page: return
+        start = time.perf_counter()
+        self.next_frame = start + self.frame_interval
+        with trace("frame") as args:
+            scroll = self.scroll + self.pending_scroll
+            self.scroll = int(min(max(scroll, 0), self.max_scroll()))
+            self.pending_scroll = 0
+            self.draw()
+        args["dropped"] = self.frames.record(self.frame_due, start, time.perf_counter())
+
     def scrolldown(self, e):
-        max_y = max(self.document.height + 2*VSTEP - HEIGHT, 0)
-        self.scroll = min(self.scroll + SCROLL_STEP, max_y)
-        self.draw()
+        if not self.page: return
+        self.schedule_frame(SCROLL_STEP)
 
     def on_mousewheel(self, event):
-        min_y = 0
-        max_y = max(self.document.height + 2*VSTEP - HEIGHT, 0)
-        new_scroll = self.scroll + int(-1 * (event.delta / 120) * SCROLL_STEP)  
-        if new_scroll >= min_y and new_scroll <= max_y: self.scroll = new_scroll
-        self.draw()
+        if not self.page: return
+        self.schedule_frame(-1 * (event.delta / 120) * SCROLL_STEP)
 
 
 class URL:
@@ -648,6 +1812,11 @@ class URL:
             self.host, port = self.host.split(":", 1)
             self.port = int(port)
 
+    def __str__(self):
+        if self.scheme == "file":
+            return "file://" + self.path
+        return f"{self.scheme}://{self.host}:{self.port}{self.path}"
+
     # converts relative to full URL's
     def resolve(self, url):
         if "://" in url:
@@ -664,9 +1833,15 @@ class URL:
                     dir, _ = dir.rsplit("/", 1)
             url = dir + "/" + url
 
+        if self.scheme == "file":
+            return URL("file://" + url)
         return URL(f"{self.scheme}://{self.host}:{self.port}{url}")
 
-    def request(self): 
+    def request(self, timeout=None):
+        return "".join(self.stream(timeout))
+
+    # yields the response body in chunks as it arrives off the socket
+    def stream(self, timeout=None):
         if self.scheme == "file":
             # local file handling
             path = os.path.join(pathlib.Path.home(), self.path[1:])
@@ -674,77 +1849,658 @@ class URL:
             if not os.path.exists(path):
                 raise FileNotFoundError(f"File not found: {path}")
             with open(path, 'r') as f:
-                return f.read()
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk: break
+                    yield chunk
+            return
  
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP,
-        )
-
-        s.connect((self.host, self.port))
-        if self.scheme == "https": 
-            # wrapping with ssl library
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
+        # fresh cache hits never touch the network
+        cache_key = str(self)
+        entry = HTTP_CACHE.get(cache_key)
+        if entry and entry.fresh():
+            yield from decode_body(entry.chunks())
+            return
+
+        key = (self.scheme, self.host, self.port)
+        headers = entry.validators() if entry else {}
+        conn, status, response_headers = self.send_request(key, timeout, headers)
+
+        encoding = response_headers.get("content-encoding", "identity").casefold()
+        if encoding not in CONTENT_ENCODINGS:
+            CONNECTION_POOL.release(conn, reusable=False)
+            raise ValueError(f"Unsupported content-encoding: {encoding}")
+
+        body = decompress_body(conn.read_body(status, response_headers), encoding)
+        if status == 304 and entry:
+            for _ in body: pass
+            entry = HTTP_CACHE.refresh(cache_key, entry, response_headers)
+            yield from decode_body(entry.chunks())
+        elif status == 200 and cacheable(response_headers):
+            yield from decode_body(HTTP_CACHE.store(cache_key, response_headers, body))
+        else:
+            if no_store(response_headers): HTTP_CACHE.delete(cache_key)
+            yield from decode_body(body)
 
-        request = f"GET {self.path} HTTP/1.0\r\n"
+    # sends the GET over a pooled connection, retrying once if a reused
+    # keep-alive socket turns out to have been closed by the server
+    def send_request(self, key, timeout=None, headers=None):
+        request = f"GET {self.path} HTTP/1.1\r\n"
         request += f"Host: {self.host}\r\n"
         request += "User-Agent: NathansBeautifulBrowser\r\n"
-        request += "Connection: close\r\n"
+        request += "Connection: keep-alive\r\n"
+        request += "Accept-Encoding: gzip, deflate\r\n"
+        for header, value in (headers or {}).items():
+            request += f"{header}: {value}\r\n"
         request += "\r\n"  # two newlines to end the headers
 
-        s.send(request.encode("utf8"))
+        conn = CONNECTION_POOL.acquire(key, timeout=timeout)
+        conn.sock.settimeout(timeout)
+        try:
+            status, response_headers = conn.exchange(request)
+        except (OSError, ValueError):
+            CONNECTION_POOL.release(conn, reusable=False)
+            if not conn.reused: raise
+            conn = CONNECTION_POOL.acquire(key, fresh=True, timeout=timeout)
+            try:
+                status, response_headers = conn.exchange(request)
+            except:
+                CONNECTION_POOL.release(conn, reusable=False)
+                raise
+        return conn, status, response_headers
+
+
+# Content-Encodings we advertise and can undo
+CONTENT_ENCODINGS = {"identity", "gzip", "x-gzip", "deflate"}
+
+# undoes Content-Encoding as the body streams in, one chunk at a time
+def decompress_body(chunks, encoding):
+    if encoding == "identity":
+        yield from chunks
+        return
+
+    if encoding == "deflate":
+        decompressor = None
+    else:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    for data in chunks:
+        if decompressor is None:
+            # servers disagree on whether deflate carries a zlib header
+            try:
+                decompressor = zlib.decompressobj()
+                data = decompressor.decompress(data)
+            except zlib.error:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = decompressor.decompress(data)
+        else:
+            data = decompressor.decompress(data)
+        if data: yield data
+
+    if decompressor:
+        data = decompressor.flush()
+        if data: yield data
+
+# decodes a stream of utf8 body bytes into text chunks
+def decode_body(chunks):
+    decoder = codecs.getincrementaldecoder("utf8")()
+    for data in chunks:
+        text = decoder.decode(data)
+        if text: yield text
+    text = decoder.decode(b"", final=True)
+    if text: yield text
+
+
+# Where cached responses live, and how much of them to keep in memory
+CACHE_DIR = os.path.join(pathlib.Path.home(), ".nathans-browser", "cache")
+MEMORY_CACHE_BYTES = 32 * 1024 * 1024
+
+def cache_control(headers):
+    directives = {}
+    for part in headers.get("cache-control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name: directives[name.casefold()] = value.strip('"')
+    return directives
+
+def no_store(headers):
+    return "no-store" in cache_control(headers)
+
+# worth storing: allowed by the server and either fresh for a while or
+# revalidatable with a conditional GET
+def cacheable(headers):
+    directives = cache_control(headers)
+    if "no-store" in directives: return False
+    return "max-age" in directives \
+        or "etag" in headers or "last-modified" in headers
+
+
+# A stored response: the headers that govern freshness plus the body, which
+# is either bytes or a memoryview over an mmapped cache file
+class CacheEntry:
+    def __init__(self, headers, stored_at, body):
+        self.headers = headers
+        self.stored_at = stored_at
+        self.body = body
+
+    def fresh(self):
+        directives = cache_control(self.headers)
+        if "no-cache" in directives: return False
+        try:
+            max_age = int(directives.get("max-age", 0))
+            age = int(self.headers.get("age", 0))
+        except ValueError:
+            return False
+        return time.time() - self.stored_at + age < max_age
+
+    # headers for a conditional GET that lets the server answer 304
+    def validators(self):
+        headers = {}
+        if "etag" in self.headers:
+            headers["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["last-modified"]
+        return headers
+
+    def chunks(self):
+        body = memoryview(self.body)
+        for i in range(0, len(body), CHUNK_SIZE):
+            yield body[i:i + CHUNK_SIZE]
+
+
+# Two-level HTTP cache keyed by resolved URL: an LRU of recent entries held
+# in memory within a byte budget, backed by one file per entry on disk
+class HTTPCache:
+    def __init__(self, directory=CACHE_DIR, memory_budget=MEMORY_CACHE_BYTES):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        name = hashlib.sha256(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        entry = self.read(key)
+        if entry: self.remember(key, entry)
+        return entry
+
+    # tees a network body into the cache, committing it once it is complete
+    def store(self, key, headers, body):
+        parts = []
+        for data in body:
+            parts.append(data)
+            yield data
+
+        headers = {name: value for name, value in headers.items()
+                   if name not in TRANSFER_HEADERS}
+        entry = CacheEntry(headers, time.time(), b"".join(parts))
+        self.write(key, entry)
+        self.remember(key, entry)
+
+    # a 304 renews the entry's freshness using the new response headers
+    def refresh(self, key, entry, headers):
+        headers = dict(entry.headers, **{
+            name: value for name, value in headers.items()
+            if name not in TRANSFER_HEADERS})
+        entry = CacheEntry(headers, time.time(), entry.body)
+        self.write(key, entry)
+        self.remember(key, entry)
+        return entry
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= len(self.memory.pop(key).body)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def remember(self, key, entry):
+        size = len(entry.body)
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= len(self.memory.pop(key).body)
+            if size > self.memory_budget: return
+            self.memory[key] = entry
+            self.memory_bytes += size
+            while self.memory_bytes > self.memory_budget:
+                _, old = self.memory.popitem(last=False)
+                self.memory_bytes -= len(old.body)
+
+    # entry files are one line of JSON metadata followed by the raw body;
+    # the body is mapped rather than read so large pages are not copied
+    def read(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0: return None
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+
+        split = mapped.find(b"\n")
+        if split == -1: return None
+        try:
+            meta = json.loads(mapped[:split])
+        except ValueError:
+            return None
+        return CacheEntry(meta["headers"], meta["stored_at"],
+                          memoryview(mapped)[split + 1:])
+
+    # writes to a temporary file and renames it into place, so readers see
+    # either the old entry or the new one, never a partial write
+    def write(self, key, entry):
+        meta = json.dumps({"headers": entry.headers, "stored_at": entry.stored_at})
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(meta.encode("utf8") + b"\n")
+                f.write(entry.body)
+            os.replace(tmp, self.path(key))
+        except OSError:
+            # e.g. the old entry is still mapped on Windows
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+# Headers that describe the transfer rather than the cached resource, which
+# is stored already decompressed
+TRANSFER_HEADERS = {
+    "connection", "keep-alive", "transfer-encoding", "content-length",
+    "content-encoding",
+}
+
+HTTP_CACHE = HTTPCache()
 
-        # reading servers response
-        response = s.makefile("r", encoding="utf8", newline="\r\n")
 
-        statusline = response.readline()
+# Shared TLS context, created on first https request
+SSL_CONTEXT = None
+# Keep-alive pool limits
+MAX_CONNECTIONS = 16
+IDLE_TIMEOUT = 30
+
+def ssl_context():
+    global SSL_CONTEXT
+    if SSL_CONTEXT is None:
+        SSL_CONTEXT = ssl.create_default_context()
+    return SSL_CONTEXT
+
+
+# A single HTTP/1.1 connection that can carry several requests
+class Connection:
+    def __init__(self, key, session=None, timeout=None):
+        scheme, host, port = key
+        self.key = key
+        self.reused = False
+        self.last_used = time.monotonic()
+
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        s.settimeout(timeout)
+        s.connect((host, port))
+        if scheme == "https":
+            # wrapping with ssl library, resuming a previous TLS session if we have one
+            s = ssl_context().wrap_socket(
+                s, server_hostname=host, session=session)
+
+        self.sock = s
+        self.response = s.makefile("rb")
+
+    # writes one request and reads back the status line and headers
+    def exchange(self, request):
+        self.sock.sendall(request.encode("utf8"))
+
+        statusline = self.response.readline().decode("latin-1")
+        if not statusline:
+            raise ConnectionError("Connection closed by server")
         version, status, explanation = statusline.split(" ", 2)
 
         # grabbing headers
         response_headers = {}
         while True:
-            line = response.readline()
-            if line == "\r\n":
+            line = self.response.readline().decode("latin-1")
+            if line in ("\r\n", "\n", ""):
                 break
             header, value = line.split(":", 1)
             response_headers[header.casefold()] = value.strip()
 
-        # weird formatting
-        assert "transfer-encoding" not in response_headers
-        assert "content-encoding" not in response_headers
-
-        content = response.read()
-        s.close()
-
-        return content
+        # HTTP/1.0 servers close unless they opt in to keep-alive
+        connection = response_headers.get("connection", "").casefold()
+        if version == "HTTP/1.0":
+            self.keep_alive = connection == "keep-alive"
+        else:
+            self.keep_alive = connection != "close"
+        return int(status), response_headers
+
+    # yields raw body bytes, framed by chunked encoding, Content-Length,
+    # or the server closing the connection; hands the socket back to the
+    # pool once the whole body has been read
+    def read_body(self, status, headers):
+        reusable = self.keep_alive
+        finished = False
+        try:
+            if status in (204, 304) or 100 <= status < 200:
+                pass
+            elif headers.get("transfer-encoding", "").casefold() == "chunked":
+                while True:
+                    size = int(self.response.readline().split(b";")[0], 16)
+                    if size == 0: break
+                    yield from self.read_exactly(size)
+                    self.response.readline()
+                # skip trailers
+                while self.response.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+            elif "content-length" in headers:
+                yield from self.read_exactly(int(headers["content-length"]))
+            else:
+                reusable = False
+                while True:
+                    data = self.response.read1(CHUNK_SIZE)
+                    if not data: break
+                    yield data
+            finished = True
+        finally:
+            CONNECTION_POOL.release(self, reusable=reusable and finished)
+
+    def read_exactly(self, size):
+        while size > 0:
+            data = self.response.read1(min(size, CHUNK_SIZE))
+            if not data:
+                raise ConnectionError("Connection closed mid-body")
+            size -= len(data)
+            yield data
+
+    def close(self):
+        self.response.close()
+        self.sock.close()
+
+
+# Keep-alive pool keyed by (scheme, host, port), capped at max_connections
+# open sockets in total; idle sockets older than idle_timeout are dropped
+class ConnectionPool:
+    def __init__(self, max_connections=MAX_CONNECTIONS,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.sessions = {}
+        self.open = 0
+        self.lock = threading.Condition()
+
+    def acquire(self, key, fresh=False, timeout=None):
+        with self.lock:
+            self.prune()
+            idle = self.idle.get(key)
+            if idle and not fresh:
+                conn = idle.pop()
+                conn.reused = True
+                return conn
+
+            # at the cap: free an idle socket to another host, or wait
+            while self.open >= self.max_connections:
+                if not self.evict_oldest():
+                    self.lock.wait()
+            self.open += 1
+            session = self.sessions.get(key)
+
+        try:
+            return Connection(key, session, timeout)
+        except:
+            with self.lock:
+                self.open -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, conn, reusable=True):
+        with self.lock:
+            if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session:
+                self.sessions[conn.key] = conn.sock.session
+            if reusable:
+                conn.last_used = time.monotonic()
+                self.idle.setdefault(conn.key, []).append(conn)
+            else:
+                conn.close()
+                self.open -= 1
+            self.lock.notify()
+
+    # drops idle connections that have been unused for too long
+    def prune(self):
+        now = time.monotonic()
+        for key, conns in self.idle.items():
+            for conn in [c for c in conns if now - c.last_used > self.idle_timeout]:
+                conns.remove(conn)
+                conn.close()
+                self.open -= 1
+
+    def evict_oldest(self):
+        conns = [c for cs in self.idle.values() for c in cs]
+        if not conns: return False
+        oldest = min(conns, key=lambda c: c.last_used)
+        self.idle[oldest.key].remove(oldest)
+        oldest.close()
+        self.open -= 1
+        return True
+
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+                    self.open -= 1
+            self.idle = {}
+
+
+CONNECTION_POOL = ConnectionPool()
 
 
 # font caching functionality
 def get_font(size, weight, style):
     key = (size, weight, style)
     if key not in FONTS:
+        FONTS[key] = FONT_BACKEND.load(size, weight, style)
+    return FONTS[key]
+
+# Real Tk fonts; needs a display and a Tk root window
+class TkFontBackend:
+    def __init__(self):
+        self.labels = []
+
+    def load(self, size, weight, style):
         font = tkinter.font.Font(size=size, weight=weight,
             slant=style)
-        label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
-    return FONTS[key][0]
+        # keeps a widget using the font alive so Tk does not free it
+        self.labels.append(tkinter.Label(font=font))
+        return font
+
+
+# Pixels per point, matching Tk's default scaling on a 96 dpi display
+GLYPH_SCALING = 96 / 72
+
+# Advance widths in thousandths of an em for printable ASCII, in order from
+# " " to "~", taken from the Helvetica and Helvetica-Bold font metrics
+GLYPH_ADVANCES = {
+    "normal": [
+        278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333,
+        278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278,
+        584, 584, 584, 556, 1015, 667, 667, 722, 722, 667, 611, 778, 722, 278,
+        500, 667, 556, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+        667, 667, 611, 278, 278, 278, 469, 556, 333, 556, 556, 500, 556, 556,
+        278, 556, 556, 222, 222, 500, 222, 833, 556, 556, 556, 556, 333, 500,
+        278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+    ],
+    "bold": [
+        278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333,
+        278, 278, 556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333,
+        584, 584, 584, 611, 975, 722, 722, 722, 722, 667, 611, 778, 722, 278,
+        556, 722, 611, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667, 944,
+        667, 667, 611, 333, 278, 333, 584, 556, 333, 556, 611, 556, 611, 556,
+        333, 611, 611, 278, 278, 556, 278, 889, 611, 611, 611, 611, 389, 556,
+        333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+    ],
+}
+GLYPH_ASCENT, GLYPH_DESCENT = 718, 207
+# advance used for characters outside the table
+GLYPH_DEFAULT = 556
+
+# A font measured from a per-weight table of glyph advances instead of Tk,
+# with the same measure/metrics interface as tkinter.font.Font
+class GlyphTableFont:
+    def __init__(self, size, advances):
+        self.size = size
+        self.advances = advances
+        self.scale = size * GLYPH_SCALING / 1000
+        ascent = round(GLYPH_ASCENT * self.scale)
+        descent = round(GLYPH_DESCENT * self.scale)
+        self.table = {"ascent": ascent, "descent": descent,
+                      "linespace": ascent + descent, "fixed": 0}
+
+    def measure(self, text):
+        advances = self.advances
+        total = sum(advances.get(c, GLYPH_DEFAULT) for c in text)
+        return round(total * self.scale)
+
+    def metrics(self, *options):
+        if options: return self.table[options[0]]
+        return dict(self.table)
+
+# Measures text from glyph advance tables, so layout runs without Tk
+class GlyphTableBackend:
+    def __init__(self, tables=GLYPH_ADVANCES):
+        self.tables = {
+            weight: {chr(32 + i): advance for i, advance in enumerate(advances)}
+            for weight, advances in tables.items()}
+
+    def load(self, size, weight, style):
+        advances = self.tables.get(weight, self.tables["normal"])
+        return GlyphTableFont(size, advances)
+
+
+FONT_BACKEND = GlyphTableBackend()
+
+# switches how fonts are measured, dropping everything measured before
+def set_font_backend(backend):
+    global FONT_BACKEND
+    FONT_BACKEND = backend
+    FONTS.clear()
+    FONT_METRICS.clear()
+    WORD_WIDTHS.clear()
+
+# Bound on the number of (font, word) widths remembered
+MAX_CACHED_WIDTHS = 100000
+# Metrics cache, keyed like FONTS
+FONT_METRICS = {}
+# LRU of (font key, word) -> width shared by all fonts
+WORD_WIDTHS = collections.OrderedDict()
+
+# Font metrics measured once per font, so layout does not go back to Tk
+# for every word
+class FontMetrics:
+    def __init__(self, key, font):
+        self.key = key
+        self.font = font
+        count_call("metrics")
+        metrics = font.metrics()
+        self.ascent = metrics["ascent"]
+        self.descent = metrics["descent"]
+        self.linespace = metrics["linespace"]
+        count_call("measure")
+        self.space = font.measure(" ")
+
+    def measure(self, word):
+        key = (self.key, word)
+        width = WORD_WIDTHS.get(key)
+        if width is None:
+            count_call("measure")
+            width = self.font.measure(word)
+            WORD_WIDTHS[key] = width
+            if len(WORD_WIDTHS) > MAX_CACHED_WIDTHS:
+                WORD_WIDTHS.popitem(last=False)
+        else:
+            WORD_WIDTHS.move_to_end(key)
+        return width
+
+def get_metrics(size, weight, style):
+    key = (size, weight, style)
+    if key not in FONT_METRICS:
+        FONT_METRICS[key] = FontMetrics(key, get_font(size, weight, style))
+    return FONT_METRICS[key]
 
 def print_tree(node, indent=0):
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        print(" " * indent, node)
+        stack.extend((child, indent + 2) for child in reversed(node.children))
 
 # general
+# yields every node of the tree in document order, without building a list
+def walk(tree):
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    list.extend(walk(tree))
     return list
 
+# characters of text under node, which layout uses to guess the height of
+# what it has not reached yet
+def text_length(node):
+    return sum(len(child.text) for child in walk(node) if isinstance(child, Text))
+
 if __name__ == "__main__":
-    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Nathan's Beautiful Browser")
+    parser.add_argument("targets", nargs="*",
+        help="URLs or files to open; @FILE reads one target per line")
+    parser.add_argument("--batch", action="store_true",
+        help="render every target headless and print JSONL summaries")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS,
+        help="worker processes for --batch")
+    parser.add_argument("--output", default="-",
+        help="where --batch writes its JSONL (default: stdout)")
+    parser.add_argument("--display-list", action="store_true",
+        help="include each page's serialized display list in --batch output")
+    parser.add_argument("--frame-rate", type=int, default=FRAME_RATE,
+        help="most frames per second to draw while scrolling")
+    parser.add_argument("--trace", metavar="FILE",
+        help="write per-stage timings and call counts as Chrome trace JSON")
+    args = parser.parse_args()
+
+    targets = []
+    for target in args.targets:
+        if target.startswith("@"):
+            with open(target[1:]) as f:
+                targets.extend(line.strip() for line in f if line.strip())
+        else:
+            targets.append(target)
+
+    if args.batch:
+        if args.output == "-":
+            render_batch(targets, sys.stdout, args.workers, args.display_list)
+        else:
+            with open(args.output, "w") as output:
+                render_batch(targets, output, args.workers, args.display_list)
+        sys.exit()
 
     # prints the tree structure of the parsed HTML in terminal
     # body = URL(sys.argv[1]).request()
@@ -752,11 +2508,12 @@ if __name__ == "__main__":
     # print_tree(nodes)
 
     # if no URL browser opens default file
-    if len(sys.argv) > 1:
-        url = URL(sys.argv[1])
+    if targets:
+        url = URL(targets[0])
     else:
         url = URL("file:///" + default_path.replace("\\", "/"))
 
-    DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
-    Browser().load(url)
-    tk.mainloop()
\ No newline at end of file
+    if args.trace: enable_tracing()
+    Browser(args.frame_rate).load(url)
+    tk.mainloop()
+    if args.trace: TRACER.dump(args.trace)
\ No newline at end of file